@@ -11,11 +11,215 @@ import time
 import socket
 import json
 import math
+import gc
+import os
+import select
+import tempfile
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import threading
 
 # ~~~~~============== CONFIGURATION  ==============~~~~~
 
 team_name = "JAMESE"
 
+# Market making (--market-make): resting quotes sit at fair value +/- the half
+# spread, shifted against our position by mm_skew per share held
+mm_half_spread = 2
+mm_skew = 0.1
+mm_quote_size = 5
+# Leave a quote alone while it is within this many dollars of its target
+mm_tolerance = 1
+# Seconds between requotes of one symbol. A requote normally sends a cancel and
+# an add per side, so 7 symbols stay near 280 messages a second, inside the
+# exchange's 500
+mm_requote_interval = 0.1
+position_limit = 50
+
+# Low latency (--low-latency): kernel socket buffer sizes, how many new objects
+# to let pile up before collecting them in an idle gap, and how long to wait for
+# data (without busy polling) before treating the wait as an idle gap
+socket_buffer_bytes = 1 << 20
+idle_gc_threshold = 700
+idle_wait_seconds = 0.001
+
+# Metrics (--metrics-port / --metrics-file): seconds between JSON snapshots
+metrics_snapshot_interval = 5
+
+# ~~~~~============== METRICS ==============~~~~~
+
+# Metrics are only ever updated from the main loop and only read by the exporter
+# thread, so updates are plain attribute and dict writes with no locking. The
+# exporter copies values out, and a reading may be a message or two behind.
+
+class Counter:
+    def __init__(self, name, help_, label=None):
+        self.name = name
+        self.help_ = help_
+        self.label = label
+        self.values = defaultdict(int) # label value -> count
+        if label is None:
+            self.values[""] = 0
+
+    def inc(self, label_value="", amount=1):
+        self.values[label_value] += amount
+
+    def snapshot(self):
+        return self.values.copy()
+
+class Gauge(Counter):
+    def set(self, value, label_value=""):
+        self.values[label_value] = value
+
+class Histogram:
+    def __init__(self, name, help_, buckets):
+        self.name = name
+        self.help_ = help_
+        self.label = None
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1) # last one is +Inf
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def snapshot(self):
+        """Returns cumulative bucket counts keyed by upper bound, plus sum and count"""
+        counts = self.counts.copy()
+        buckets = {}
+        running = 0
+        for bound, count in zip(self.bounds + ["+Inf"], counts):
+            running += count
+            buckets[str(bound)] = running
+        return {"buckets": buckets, "sum": self.sum, "count": running}
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_, label=None):
+        return self._register(Counter(name, help_, label))
+
+    def gauge(self, name, help_, label=None):
+        return self._register(Gauge(name, help_, label))
+
+    def histogram(self, name, help_, buckets):
+        return self._register(Histogram(name, help_, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        """Returns every metric's current values as plain JSON-able data"""
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def prometheus_text(self):
+        """Renders the registry in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            values = metric.snapshot()
+            kind = type(metric).__name__.lower()
+            lines.append(f"# HELP {metric.name} {metric.help_}")
+            lines.append(f"# TYPE {metric.name} {kind}")
+            if isinstance(metric, Histogram):
+                for bound, count in values["buckets"].items():
+                    lines.append(f'{metric.name}_bucket{{le="{bound}"}} {count}')
+                lines.append(f"{metric.name}_sum {values['sum']}")
+                lines.append(f"{metric.name}_count {values['count']}")
+                continue
+            for label_value, value in values.items():
+                if metric.label is None:
+                    lines.append(f"{metric.name} {value}")
+                else:
+                    lines.append(f'{metric.name}{{{metric.label}="{label_value}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+class MetricsExporter(threading.Thread):
+    """Serves the registry over HTTP on localhost and writes it to a JSON file
+    every metrics_snapshot_interval seconds, off the trading thread"""
+
+    def __init__(self, registry, port=None, snapshot_path=None):
+        super().__init__(name="metrics", daemon=True)
+        self.registry = registry
+        self.snapshot_path = snapshot_path
+        self.server = None
+        if port is not None:
+            self.server = HTTPServer(("127.0.0.1", port), self._handler())
+
+    def _handler(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            # Give up on clients that connect and go quiet, so they cannot hold
+            # up the snapshots written from the same thread
+            timeout = 1
+
+            def do_GET(self):
+                body = registry.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Keep request logs out of the bot's output
+                pass
+
+        return Handler
+
+    def write_snapshot(self):
+        """Writes the snapshot to a fresh temporary file next to its destination
+        first, so readers never see a half-written file and concurrent writers
+        never share one. A failed write is reported rather than raised, so it can
+        neither stop the exporter nor the bot"""
+        snapshot = {"time": time.time(), "metrics": self.registry.snapshot()}
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        partial_path = None
+        try:
+            with tempfile.NamedTemporaryFile(
+                "w", dir=directory, suffix=".tmp", delete=False
+            ) as f:
+                partial_path = f.name
+                json.dump(snapshot, f)
+            os.replace(partial_path, self.snapshot_path)
+        except OSError as e:
+            print("Unable to write metrics snapshot:", e)
+            if partial_path is not None and os.path.exists(partial_path):
+                os.remove(partial_path)
+
+    def run(self):
+        next_snapshot = time.monotonic()
+        while True:
+            if self.snapshot_path and time.monotonic() >= next_snapshot:
+                self.write_snapshot()
+                next_snapshot += metrics_snapshot_interval
+            wait = max(0, next_snapshot - time.monotonic())
+            if self.server is None:
+                time.sleep(wait)
+            else:
+                self.server.timeout = wait if self.snapshot_path else None
+                self.server.handle_request()
+
+metrics = MetricsRegistry()
+messages_received_metric = metrics.counter(
+    "bot_messages_received_total", "Messages read from the exchange", "type"
+)
+orders_sent_metric = metrics.counter("bot_orders_sent_total", "Add orders sent", "symbol")
+acks_metric = metrics.counter("bot_acks_total", "Acks on our orders")
+rejects_metric = metrics.counter("bot_rejects_total", "Rejects of our orders")
+fills_metric = metrics.counter("bot_fills_total", "Fills on our orders", "symbol")
+open_orders_metric = metrics.gauge("bot_open_orders", "Orders live on the exchange")
+positions_metric = metrics.gauge("bot_position", "Shares held", "symbol")
+pnl_metric = metrics.gauge("bot_pnl", "Cash plus positions marked at the average price")
+loop_lag_metric = metrics.histogram(
+    "bot_loop_lag_seconds",
+    "Time from reading a message to being ready for the next one",
+    [0.00001, 0.00003, 0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1],
+)
+
 # ~~~~~============== MAIN LOOP ==============~~~~~
 
 class Order:
@@ -48,6 +252,8 @@ class StateManager:
         self.positions = {} # stocks we have
         self.unacked_orders = {} # orders not yet live
         self.open_orders = {} # orders that are live
+        self.cash = 0 # money made (or spent) on fills this round
+        self.pending_cancels = set() # order ids we have asked to cancel
         # Start ids at -1 because we always increment when getting the next ID
         self.cur_id = -1
 
@@ -63,6 +269,25 @@ class StateManager:
         #print(f"Sending order {order}")
         order.send(self.exchange)
         self.unacked_orders[order_id] = order
+        orders_sent_metric.inc(symbol)
+
+    def cancel_order(self, order_id):
+        """Asks the exchange to cancel a live order, remembering that we did so"""
+        self.exchange.send_cancel_message(order_id)
+        self.pending_cancels.add(order_id)
+
+    def resting_orders(self, symbol, dir_):
+        """Returns our orders on one side of a symbol that are (or are about to be)
+        resting on the book, skipping ones already being cancelled"""
+        return [
+            order
+            for orders in (self.open_orders, self.unacked_orders)
+            for order in orders.values()
+            if order.symbol == symbol
+            and order.dir_ == dir_
+            and order.size > 0
+            and order.id_ not in self.pending_cancels
+        ]
 
     def on_hello(self, hello_message):
         """Handle a hello message by setting our current positions"""
@@ -71,20 +296,30 @@ class StateManager:
             symbol = symbol_position["symbol"]
             position = symbol_position["position"]
             self.positions[symbol] = position
+            positions_metric.set(position, symbol)
         print(self.positions)
 
     def on_ack(self, message):
         """Handle an ack by marking the order as live"""
         order_id = message["order_id"]
+        acks_metric.inc()
         if order_id in self.unacked_orders:
             self.open_orders[order_id] = self.unacked_orders.pop(order_id)
             #print("Got ack on order", self.open_orders[order_id])
         else:
             print("Unexpectedly got ack on unknown order_id", order_id)
 
+    def on_reject(self, message):
+        """Handle a reject by forgetting the order, it will never go live"""
+        rejects_metric.inc()
+        order_id = message.get("order_id")
+        self.unacked_orders.pop(order_id, None)
+        self.pending_cancels.discard(order_id)
+
     def on_out(self, message):
         """Handle an out by removing the order"""
         order_id = message["order_id"]
+        self.pending_cancels.discard(order_id)
         if order_id in self.open_orders:
             order = self.open_orders.pop(order_id)
             #print(f"Got out on order {order}")
@@ -101,6 +336,9 @@ class StateManager:
         size_multiplier = 1 if dir_ == Dir.BUY.value else -1
         size = raw_size * size_multiplier
         self.positions[symbol] = self.positions.get(symbol, 0) + size
+        self.cash -= message["price"] * size
+        fills_metric.inc(symbol)
+        positions_metric.set(self.positions[symbol], symbol)
         if order_id in self.open_orders:
             self.open_orders[order_id].size -= raw_size
         else:
@@ -109,6 +347,14 @@ class StateManager:
                 order_id,
             )
 
+    def pnl(self, marks):
+        """Returns cash plus every position we have a mark for valued at it"""
+        return self.cash + sum(
+            position * marks[symbol]
+            for symbol, position in self.positions.items()
+            if symbol in marks
+        )
+
 
 def determine_sell(avg_stock, current_trades_buy, state_manager, threshold):
     # selling logic
@@ -132,13 +378,82 @@ def determine_buy(avg_stock, current_trades_sell, state_manager, threshold):
 
     return "optimal buy not found"
 
+def target_quotes(fair_value, position, best_bid=None, best_ask=None):
+    """Returns the {dir: (price, size)} quotes we want resting around fair_value.
+    Quotes are skewed against our position, and a side is dropped when filling it
+    could push us past the position limit. When the book is known, quotes are kept
+    off the other side of it so they rest instead of trading straight away"""
+    center = fair_value - mm_skew * position
+    bid = math.floor(center - mm_half_spread)
+    ask = max(math.ceil(center + mm_half_spread), bid + 1)
+    if best_ask is not None:
+        bid = min(bid, best_ask - 1)
+    if best_bid is not None:
+        ask = max(ask, best_bid + 1)
+    targets = {}
+    if position + mm_quote_size <= position_limit:
+        targets[Dir.BUY] = (bid, mm_quote_size)
+    if position - mm_quote_size >= -position_limit:
+        targets[Dir.SELL] = (ask, mm_quote_size)
+    return targets
+
+def plan_requote(resting, target, tolerance):
+    """Works out the fewest messages taking one side of a symbol from the resting
+    orders to the target (price, size) quote, or to no quote if target is None.
+
+    Returns (order ids to cancel, (price, size) quotes to add). Orders within
+    tolerance of the target price are kept, closest first, as long as together
+    they do not exceed the target size, and any size still missing (say after a
+    partial fill) is added at the target price."""
+    if target is None:
+        return [order.id_ for order in resting], []
+    price, size = target
+    near = sorted(
+        (order for order in resting if abs(order.price - price) <= tolerance),
+        key=lambda order: abs(order.price - price),
+    )
+    kept = set()
+    kept_size = 0
+    for order in near:
+        if kept_size + order.size <= size:
+            kept.add(order.id_)
+            kept_size += order.size
+    cancels = [order.id_ for order in resting if order.id_ not in kept]
+    adds = [(price, size - kept_size)] if kept_size < size else []
+    return cancels, adds
+
+def requote(symbol, fair_value, state_manager, best_bid=None, best_ask=None):
+    """Moves our quotes in symbol towards the targets for fair_value, sending only
+    the cancels and adds needed to get there"""
+    targets = target_quotes(
+        fair_value, state_manager.positions.get(symbol, 0), best_bid, best_ask
+    )
+    for dir_ in Dir:
+        resting = state_manager.resting_orders(symbol, dir_)
+        if any(order.id_ in state_manager.unacked_orders for order in resting):
+            # Wait for the ack before touching this side again
+            continue
+        cancels, adds = plan_requote(resting, targets.get(dir_), mm_tolerance)
+        for order_id in cancels:
+            state_manager.cancel_order(order_id)
+        for price, size in adds:
+            state_manager.new_order(symbol, dir_, price, size)
+
 def main():
     threshold = {key: 10 for key in ["DETG", "DRYR", "QROLL", "SOFT", "UMBR", "UMBRS", "WASH"]}
     args = parse_arguments()
+    if args.cpu is not None:
+        pin_to_cpu(args.cpu)
+    exporter = None
+    if args.metrics_port is not None or args.metrics_file:
+        exporter = MetricsExporter(metrics, args.metrics_port, args.metrics_file)
+        exporter.start()
     exchange = ExchangeConnection(args=args)
     state_manager = StateManager(exchange)
     hello_message = exchange.read_message()
     state_manager.on_hello(hello_message)
+    if args.low_latency:
+        freeze_heap(exchange)
     message_ticker = 0
     total_trades = defaultdict(list)
     avg_stock = {}
@@ -151,12 +466,32 @@ def main():
             return 0
         return sum(trade[0] * trade[1] for trade in trades) / total_weight
 
+    last_requote = {}
+
+    def make_market(symbol):
+        # Requoting is rate limited per symbol to stay inside the message budget
+        now = time.monotonic()
+        if symbol not in avg_stock or now - last_requote.get(symbol, 0) < mm_requote_interval:
+            return
+        last_requote[symbol] = now
+        book_buy = current_trades_buy.get(symbol)
+        book_sell = current_trades_sell.get(symbol)
+        requote(
+            symbol,
+            avg_stock[symbol],
+            state_manager,
+            best_bid=book_buy[0][0] if book_buy else None,
+            best_ask=book_sell[0][0] if book_sell else None,
+        )
+
     while True:
         changed = False
         message = exchange.read_message()
+        loop_started = time.perf_counter()
         message_ticker += 1
+        messages_received_metric.inc(message["type"])
 
-        if len(avg_stock.keys()) == 7 and message_ticker % 2 == 0 and not state_manager.open_orders.keys():
+        if not args.market_make and len(avg_stock.keys()) == 7 and message_ticker % 2 == 0 and not state_manager.open_orders.keys():
             sold = determine_sell(avg_stock, current_trades_buy, state_manager, threshold)
             if sold == "optimal sell not found":
                 bought = determine_buy(avg_stock, current_trades_sell, state_manager, threshold)
@@ -172,13 +507,18 @@ def main():
             print(message)
         elif message["type"] == "reject":
             print(message)
+            state_manager.on_reject(message)
         elif message["type"] == "ack":
             print("acknowledgement of order")
             state_manager.on_ack(message)
+            if args.market_make and message["order_id"] in state_manager.open_orders:
+                make_market(state_manager.open_orders[message["order_id"]].symbol)
         elif message["type"] == "out":
             state_manager.on_out(message)
         elif message["type"] == "fill":
             state_manager.on_fill(message)
+            if args.market_make:
+                make_market(message["symbol"])
         elif message["type"] == "book":
             current_trades_buy[message["symbol"]] = message["buy"]
             current_trades_sell[message["symbol"]] = message["sell"]
@@ -186,13 +526,47 @@ def main():
             cur_trade = message["symbol"]
             total_trades[cur_trade].append((message["price"], message["size"], time.time()))
             avg_stock[cur_trade] = weighted_average(total_trades[cur_trade][-10:]) if len(total_trades[cur_trade]) >= 10 else weighted_average(total_trades[cur_trade])
+            if args.market_make:
+                make_market(cur_trade)
+
+        if message["type"] in ("fill", "trade"):
+            pnl_metric.set(state_manager.pnl(avg_stock))
+        open_orders_metric.set(len(state_manager.open_orders))
 
         if any(value for value in state_manager.positions.values()) and changed:
             print("current positions")
             print(state_manager.positions)
 
+        loop_lag_metric.observe(time.perf_counter() - loop_started)
+
+    if exporter is not None and exporter.snapshot_path:
+        exporter.write_snapshot()
     print("round over fasho")
 
+# ~~~~~============== RUNTIME TUNING ==============~~~~~
+
+def pin_to_cpu(cpu):
+    """Keeps the process on a single CPU so the scheduler does not move it around
+    (and throw away its caches) mid-round"""
+    os.sched_setaffinity(0, {cpu})
+
+def freeze_heap(exchange):
+    """Once warmed up, moves everything allocated so far out of the collector's
+    reach. Automatic collection is then switched off and left to
+    collect_when_idle, which only runs while no data is waiting"""
+    gc.collect()
+    gc.freeze()
+    gc.disable()
+    exchange.on_idle = collect_when_idle
+
+def collect_when_idle():
+    """Runs the collection automatic gc would have run, mirroring its default
+    10:10 ratio between generations"""
+    gen0, gen1, gen2 = gc.get_count()
+    if gen0 < idle_gc_threshold:
+        return
+    gc.collect(2 if gen2 >= 10 else 1 if gen1 >= 10 else 0)
+
 # ~~~~~============== PROVIDED CODE ==============~~~~~
 
 # You probably don't need to edit anything below this line, but feel free to
@@ -208,15 +582,29 @@ class ExchangeConnection:
         self.message_timestamps = deque(maxlen=500)
         self.exchange_hostname = args.exchange_hostname
         self.port = args.port
+        self.add_socket_timeout = args.add_socket_timeout
+        self.low_latency = args.low_latency
+        self.busy_poll = args.busy_poll
+        # Called while waiting in _poll_line with no data to read
+        self.on_idle = lambda: None
+        self._buffer = bytearray()
         exchange_socket = self._connect(add_socket_timeout=args.add_socket_timeout)
-        self.reader = exchange_socket.makefile("r", 1)
+        self.reader = (
+            None
+            if self.low_latency or self.busy_poll
+            else exchange_socket.makefile("r", 1)
+        )
         self.writer = exchange_socket
 
         self._write_message({"type": "hello", "team": team_name.upper()})
 
     def read_message(self):
         """Read a single message from the exchange"""
-        message = json.loads(self.reader.readline())
+        if self.reader is None:
+            line = self._poll_line()
+        else:
+            line = self.reader.readline()
+        message = json.loads(line)
         if "dir" in message:
             message["dir"] = Dir(message["dir"])
         return message
@@ -252,15 +640,55 @@ class ExchangeConnection:
         """Cancel an existing order"""
         self._write_message({"type": "cancel", "order_id": order_id})
 
+    def _poll_line(self):
+        """Wait until a whole line has arrived, spinning on the non-blocking socket
+        when busy polling and waiting in short selects otherwise. Each empty spin or
+        select is an idle gap and calls on_idle"""
+        last_data = time.monotonic()
+        while True:
+            end = self._buffer.find(b"\n")
+            if end >= 0:
+                line = bytes(self._buffer[: end + 1])
+                del self._buffer[: end + 1]
+                return line
+            chunk = None
+            if self.busy_poll:
+                try:
+                    chunk = self.writer.recv(65536)
+                except BlockingIOError:
+                    pass
+            elif select.select([self.writer], [], [], idle_wait_seconds)[0]:
+                chunk = self.writer.recv(65536)
+            if chunk is None:
+                if self.add_socket_timeout and time.monotonic() - last_data > 5:
+                    raise socket.timeout("timed out")
+                self.on_idle()
+                continue
+            if not chunk:
+                return b""
+            self._buffer += chunk
+            last_data = time.monotonic()
+
     def _connect(self, add_socket_timeout):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
+        if self.low_latency:
+            # Send small orders straight away rather than batching them up, and
+            # give the kernel room to absorb bursts of book updates. Buffer sizes
+            # have to be set before connecting to affect the TCP window.
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, socket_buffer_bytes)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, socket_buffer_bytes)
+
         if add_socket_timeout:
             # Automatically raise an exception if no data has been recieved for
             # multiple seconds. This should not be enabled on an "empty" test
             # exchange.
             s.settimeout(5)
         s.connect((self.exchange_hostname, self.port))
+        if self.busy_poll:
+            # _poll_line enforces the timeout itself
+            s.setblocking(False)
         return s
 
     def _write_message(self, message):
@@ -271,9 +699,13 @@ class ExchangeConnection:
         length_to_send = len(what_to_write)
         total_sent = 0
         while total_sent < length_to_send:
-            sent_this_time = self.writer.send(
-                what_to_write[total_sent:].encode("utf-8")
-            )
+            try:
+                sent_this_time = self.writer.send(
+                    what_to_write[total_sent:].encode("utf-8")
+                )
+            except BlockingIOError:
+                # Only possible when busy polling: the send buffer is full
+                continue
             if sent_this_time == 0:
                 raise Exception("Unable to send data to exchange")
             total_sent += sent_this_time
@@ -308,6 +740,37 @@ def parse_arguments():
         "--specific-address", type=str, metavar="HOST:PORT", help=argparse.SUPPRESS
     )
 
+    parser.add_argument(
+        "--market-make",
+        action="store_true",
+        help="Keep two-sided quotes resting around fair value instead of taking.",
+    )
+
+    parser.add_argument(
+        "--low-latency",
+        action="store_true",
+        help="Tune the socket and freeze the heap after warm-up.",
+    )
+    parser.add_argument(
+        "--busy-poll",
+        action="store_true",
+        help="Spin on a non-blocking socket instead of blocking in readline.",
+    )
+    parser.add_argument(
+        "--cpu", type=int, help="Pin the process to this CPU."
+    )
+
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve Prometheus metrics on this localhost port.",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        help="Write a JSON snapshot of the metrics to this file periodically.",
+    )
+
     args = parser.parse_args()
     args.add_socket_timeout = True
 
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# ~~~~~==============   HOW TO RUN   ==============~~~~~
+# ./latency-bench.py [--rounds N] [--cpu N]
+#
+# Starts a stand-in exchange on localhost and measures, from the exchange's side,
+# how long the bot's ExchangeConnection takes to answer each book update with an
+# order. The same run is done with the default settings, with --low-latency and
+# with --low-latency --busy-poll, and the latency percentiles are printed side by
+# side. Busy polling needs a spare CPU: on a single CPU it fights the stand-in
+# exchange for time and comes out far slower.
+
+import argparse
+import multiprocessing
+import socket
+import json
+import time
+
+from bot import ExchangeConnection, freeze_heap, pin_to_cpu
+
+symbols = ["DETG", "DRYR", "QROLL", "SOFT", "UMBR", "UMBRS", "WASH"]
+percentiles = [50, 90, 99, 99.9]
+
+def stand_in_exchange(listener, rounds, results):
+    """Plays the exchange for one connection: says hello, then sends trades and
+    book updates, timing how long each book takes to be answered"""
+    connection, _ = listener.accept()
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reader = connection.makefile("r", 1)
+    reader.readline()
+    hello = {
+        "type": "hello",
+        "symbols": [{"symbol": symbol, "position": 0} for symbol in symbols],
+    }
+    connection.sendall((json.dumps(hello) + "\n").encode("utf-8"))
+
+    latencies = []
+    for round_ in range(rounds):
+        symbol = symbols[round_ % len(symbols)]
+        trade = {"type": "trade", "symbol": symbol, "price": 1000 + round_ % 10, "size": 1}
+        book = {
+            "type": "book",
+            "symbol": symbol,
+            "buy": [[999, 5], [998, 10]],
+            "sell": [[1001, 5], [1002, 10]],
+        }
+        connection.sendall((json.dumps(trade) + "\n").encode("utf-8"))
+        sent = time.perf_counter_ns()
+        connection.sendall((json.dumps(book) + "\n").encode("utf-8"))
+        reader.readline()
+        latencies.append(time.perf_counter_ns() - sent)
+        # Stay under the 500 messages a second the bot may send back, leaving
+        # idle gaps between updates like the real exchange does
+        time.sleep(0.0025)
+
+    connection.sendall(b'{"type": "close"}\n')
+    connection.close()
+    results.put(latencies)
+
+def run_bot(port, low_latency, busy_poll, cpu):
+    """Trades against the stand-in like main() does: keeps every trade around and
+    answers every book update with an order"""
+    if cpu is not None:
+        pin_to_cpu(cpu)
+    args = argparse.Namespace(
+        exchange_hostname="127.0.0.1",
+        port=port,
+        add_socket_timeout=True,
+        low_latency=low_latency,
+        busy_poll=busy_poll,
+    )
+    exchange = ExchangeConnection(args=args)
+    exchange.read_message()
+    if low_latency:
+        freeze_heap(exchange)
+
+    total_trades = []
+    order_id = 0
+    while True:
+        message = exchange.read_message()
+        if message["type"] == "close":
+            break
+        elif message["type"] == "trade":
+            total_trades.append({"price": message["price"], "size": message["size"]})
+        elif message["type"] == "book":
+            price, size = message["sell"][0]
+            exchange.send_add_message(order_id, message["symbol"], "BUY", price, size)
+            order_id += 1
+
+def measure(rounds, low_latency, busy_poll, cpu):
+    """Returns the sorted reply latencies, in microseconds, of one run. The bot
+    gets a fresh process so the gc settings of one run do not leak into the next"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    results = multiprocessing.Queue()
+    exchange = multiprocessing.Process(
+        target=stand_in_exchange, args=(listener, rounds, results)
+    )
+    bot = multiprocessing.Process(
+        target=run_bot, args=(listener.getsockname()[1], low_latency, busy_poll, cpu)
+    )
+    exchange.start()
+    bot.start()
+    latencies = results.get()
+    exchange.join()
+    bot.join()
+    listener.close()
+    return sorted(latency / 1000 for latency in latencies)
+
+def percentile(sorted_values, pct):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare bot latency profiles.")
+    parser.add_argument("--rounds", type=int, default=4000)
+    parser.add_argument("--cpu", type=int, help="CPU to pin the low latency runs to.")
+    args = parser.parse_args()
+
+    runs = {
+        "default": measure(args.rounds, False, False, None),
+        "low-lat": measure(args.rounds, True, False, args.cpu),
+        "busy-poll": measure(args.rounds, True, True, args.cpu),
+    }
+
+    print(f"reply latency over {args.rounds} book updates, in microseconds")
+    print(f"{'':>8}" + "".join(f"{name:>12}" for name in runs))
+    for pct in percentiles:
+        print(f"{'p' + str(pct):>8}" + "".join(
+            f"{percentile(latencies, pct):>12.1f}" for latencies in runs.values()
+        ))
+    print(f"{'max':>8}" + "".join(f"{latencies[-1]:>12.1f}" for latencies in runs.values()))
+
+if __name__ == "__main__":
+    main()